@@ -0,0 +1,24 @@
+# Gunicorn configuration for serving the voice assistant in production.
+# Usage: gunicorn -c gunicorn.conf.py langgraph_agent:app
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# /api/chat spends almost all of its time waiting on Groq and the TTS backend,
+# so each worker runs a pool of threads that overlap those network waits.
+# Threads (rather than gevent greenlets) keep the per-thread SQLite connections
+# in langgraph_agent reused across requests.
+# Hot session state lives in each process's memory, so a single worker is the
+# default: every turn of a session must reach the same process. Scale with threads.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+# STT -> LLM -> TTS round-trips can take several seconds.
+timeout = 120
+
+
+def post_worker_init(worker):
+    # Runs once in each worker after the app module has been loaded
+    from langgraph_agent import init_app
+    init_app()
@@ -2,22 +2,36 @@ import sqlite3
 import json
 import os
 import io
+import base64
 import operator
+import re
+import struct
 import logging
-from typing import TypedDict, Annotated, List, Union
-from pathlib import Path
+import threading
+import queue
+import pickle
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TypedDict, Annotated, List, Union, Callable, Iterable, Iterator
 
 # --- Third-party imports for the server and voice capabilities ---
-from flask import Flask, request, jsonify, send_file, make_response
+from flask import Flask, Response, request, jsonify, send_file, make_response, stream_with_context
 from flask_cors import CORS
 # Using the standard 'groq' library for Whisper STT
 from groq import Groq
-# Using gTTS for simple TTS synthesis
+# Using gTTS as a network fallback when the local Piper voice is unavailable
 from gtts import gTTS
 from dotenv import load_dotenv
+import httpx
+from cachetools import TTLCache
 
 # --- LangChain/LangGraph imports (User's original code) ---
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, ToolMessage
+from langchain_core.messages import trim_messages, get_buffer_string, message_chunk_to_message
+from langchain_core.messages.utils import count_tokens_approximately
 from langchain_groq import ChatGroq
 from langchain_core.tools import tool
 from langgraph.graph import StateGraph, END
@@ -26,41 +40,207 @@ from langgraph.graph import StateGraph, END
 logging.basicConfig(level=logging.INFO)
 load_dotenv()
 DB_FILE = "customer_support.db"
-# Session storage for LangGraph state
-conversation_history = {}
 GROQ_MODEL = "llama-3.3-70b-versatile"
+# Cheaper model used to summarize older conversation turns
+SUMMARY_MODEL = "llama-3.1-8b-instant"
+# Shared pool for overlapping independent blocking steps within a request
+io_executor = ThreadPoolExecutor(max_workers=int(os.getenv("IO_POOL_SIZE", "8")))
+
+try:
+    # HTTP/2 needs the optional 'h2' package (pip install "httpx[http2]")
+    import h2  # noqa: F401
+    GROQ_HTTP2 = True
+except ImportError:
+    logging.warning("h2 is not installed. Groq calls will use pooled HTTP/1.1 connections.")
+    GROQ_HTTP2 = False
+
+# One pooled client shared by the Whisper and chat clients, so Groq calls reuse warm connections.
+# The timeout matches the Groq SDK's own 60s default, which long Whisper uploads can need.
+groq_http_client = httpx.Client(
+    http2=GROQ_HTTP2,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+)
 
 try:
     # Initialize the Groq client for Whisper transcription
-    groq_client = Groq()
+    groq_client = Groq(http_client=groq_http_client)
 except Exception as e:
     logging.error(f"Error initializing Groq client: {e}. Check your GROQ_API_KEY.")
     groq_client = None
 
+PIPER_VOICE_PATH = os.getenv("PIPER_VOICE", "en_US-amy-low.onnx")
+try:
+    # Load the local Piper voice once so TTS runs in-process instead of over the network
+    from piper.voice import PiperVoice
+    piper_voice = PiperVoice.load(PIPER_VOICE_PATH)
+except Exception as e:
+    logging.warning(f"Piper TTS unavailable ({e}). Falling back to gTTS.")
+    piper_voice = None
+
 # Initialize Flask App
 app = Flask(__name__)
-CORS(app)  # Enable CORS for client interaction
+# Enable CORS for client interaction; the custom response headers must be exposed to be readable
+CORS(app, expose_headers=["X-Session-ID", "X-Transcription-B64", "X-Transcription-Truncated"])
 
 
 # --- Database Setup (User's original code) ---
 
-def setup_database():
-    """Initializes the SQLite database and creates the 'issues' table."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS issues (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            issue TEXT NOT NULL
+# SQL statements are kept at module level so sqlite3's per-connection statement
+# cache reuses the prepared statements across tool calls.
+INSERT_ISSUE_SQL = "INSERT INTO issues (name, issue) VALUES (?, ?)"
+SELECT_ISSUES_BY_NAME_SQL = "SELECT name, issue FROM issues_fts WHERE issues_fts MATCH ? ORDER BY rank LIMIT 50"
+SELECT_RECENT_ISSUES_SQL = "SELECT name, issue FROM issues ORDER BY id DESC LIMIT 3"
+UPSERT_SESSION_SQL = "INSERT OR REPLACE INTO sessions (id, state, updated) VALUES (?, ?, ?)"
+SELECT_SESSION_SQL = "SELECT state FROM sessions WHERE id = ?"
+
+_local = threading.local()
+
+
+def _conn():
+    """Returns this thread's SQLite connection, opening it (in WAL mode) on first use."""
+    if not hasattr(_local, 'c'):
+        _local.c = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        _local.c.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA temp_store=MEMORY;"
         )
-    """)
-    conn.commit()
-    conn.close()
-    print(f"Database setup complete: {DB_FILE} and 'issues' table ready.")
+    return _local.c
+
+
+# Bump SCHEMA_VERSION whenever SCHEMA_SQL changes so existing databases are migrated
+SCHEMA_VERSION = 1
+SCHEMA_SQL = f"""
+    BEGIN IMMEDIATE;
+    CREATE TABLE IF NOT EXISTS issues (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        issue TEXT NOT NULL
+    );
+    -- Name lookups go through the FTS5 index below; a b-tree index cannot serve '%name%'
+    DROP INDEX IF EXISTS idx_issues_name;
+    CREATE VIRTUAL TABLE IF NOT EXISTS issues_fts USING fts5(
+        name, issue, content='issues', content_rowid='id'
+    );
+    CREATE TRIGGER IF NOT EXISTS issues_ai AFTER INSERT ON issues BEGIN
+        INSERT INTO issues_fts(rowid, name, issue) VALUES (new.id, new.name, new.issue);
+    END;
+    CREATE TRIGGER IF NOT EXISTS issues_ad AFTER DELETE ON issues BEGIN
+        INSERT INTO issues_fts(issues_fts, rowid, name, issue) VALUES ('delete', old.id, old.name, old.issue);
+    END;
+    CREATE TRIGGER IF NOT EXISTS issues_au AFTER UPDATE ON issues BEGIN
+        INSERT INTO issues_fts(issues_fts, rowid, name, issue) VALUES ('delete', old.id, old.name, old.issue);
+        INSERT INTO issues_fts(rowid, name, issue) VALUES (new.id, new.name, new.issue);
+    END;
+    -- Index any tickets registered before the FTS table existed
+    INSERT INTO issues_fts(issues_fts) VALUES ('rebuild');
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        state BLOB NOT NULL,
+        updated REAL NOT NULL
+    );
+    PRAGMA user_version = {SCHEMA_VERSION};
+    COMMIT;
+"""
 
 
-setup_database()
+def setup_database():
+    """Creates the database schema, skipping the work when PRAGMA user_version shows it is current."""
+    conn = _conn()
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    if version >= SCHEMA_VERSION:
+        return
+    conn.executescript(SCHEMA_SQL)
+    print(f"Database setup complete: {DB_FILE} with 'issues' and 'sessions' tables ready.")
+
+
+# Ticket inserts are queued and committed in batches by a single writer thread,
+# so a burst of registrations shares one transaction (and one fsync).
+WRITE_BATCH_SIZE = 500
+_write_q = queue.Queue()
+_writer_lock = threading.Lock()
+_writer_thread = None
+
+
+def _write_batch(batch: list):
+    """Commits one batch of queued inserts in a single transaction and resolves the callers' futures."""
+    conn = None
+    try:
+        conn = _conn()
+        conn.execute("BEGIN")
+        conn.executemany(INSERT_ISSUE_SQL, [(name, issue) for name, issue, _ in batch])
+        conn.execute("COMMIT")
+    except Exception as e:
+        if conn is not None and conn.in_transaction:
+            try:
+                conn.execute("ROLLBACK")
+            except Exception as rollback_error:
+                logging.error(f"Error rolling back issue batch: {rollback_error}")
+                # Drop the broken connection so the next batch opens a fresh one
+                del _local.c
+        for _, _, future in batch:
+            future.set_exception(e)
+    else:
+        for _, _, future in batch:
+            future.set_result(None)
+
+
+def _drain_writes():
+    """Writer loop: commits every queued insert in batches; a failed batch fails only its own callers."""
+    while True:
+        # Block for the first row, then take whatever else queued up meanwhile
+        batch = [_write_q.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
+        _write_batch(batch)
+
+
+def enqueue_issue(name: str, issue: str) -> Future:
+    """Queues an issue insert, starting the writer thread on first use. The future resolves once committed."""
+    global _writer_thread
+    if _writer_thread is None or not _writer_thread.is_alive():
+        with _writer_lock:
+            # Also restarts the writer should it ever have died, so queued rows are not stranded
+            if _writer_thread is None or not _writer_thread.is_alive():
+                _writer_thread = threading.Thread(target=_drain_writes, name="issue-writer", daemon=True)
+                _writer_thread.start()
+    future = Future()
+    _write_q.put((name, issue, future))
+    return future
+
+
+# --- Session Storage ---
+
+def _spill_session(session_id: str, state: dict):
+    """Persists an evicted session to SQLite so it can be restored on its next request."""
+    try:
+        _conn().execute(UPSERT_SESSION_SQL, (session_id, pickle.dumps(state), time.time()))
+    except Exception as e:
+        logging.error(f"Error spilling session {session_id}: {e}")
+
+
+class SessionCache(TTLCache):
+    """Bounded in-memory session store that spills evicted and expired sessions to SQLite."""
+
+    def popitem(self):
+        session_id, state = super().popitem()
+        _spill_session(session_id, state)
+        return session_id, state
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for session_id, state in expired or ():
+            _spill_session(session_id, state)
+        return expired
+
+
+# Session storage for LangGraph state (hot sessions only; cold ones live in SQLite)
+conversation_history = SessionCache(maxsize=10_000, ttl=3600)
+session_lock = threading.Lock()
 
 
 # --- Tool Definitions (User's original code) ---
@@ -72,17 +252,13 @@ def register_customer_issue(name: str, issue: str) -> str:
     Requires the customer's full name and a description of the issue.
     Returns a confirmation message with the name and issue status.
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO issues (name, issue) VALUES (?, ?)", (name, issue))
-        conn.commit()
+        # No timeout: the writer always resolves the future, and reporting a failure for a row
+        # that is still committed afterwards would make the LLM retry and duplicate the ticket
+        enqueue_issue(name, issue).result()
         return f"Issue registered successfully for {name}. Issue description: '{issue}'. You can now confirm to the user that their ticket has been created."
     except Exception as e:
-        conn.rollback()
         return f"Error registering issue: {e}"
-    finally:
-        conn.close()
 
 
 @tool
@@ -92,22 +268,19 @@ def get_customer_issues(name: str = None) -> str:
     If 'name' is provided, it fetches issues only for that customer.
     If 'name' is None, it fetches the three most recent issues for a general overview.
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    conn = _conn()
 
     if name:
-        cursor.execute("SELECT name, issue FROM issues WHERE name LIKE ? ORDER BY id DESC", ('%' + name + '%',))
-        results = cursor.fetchall()
+        # Phrase prefix query on the name column, e.g. name:"john sm"* matches "John Smith"
+        match_query = 'name:"' + name.replace('"', '""') + '"*'
+        results = conn.execute(SELECT_ISSUES_BY_NAME_SQL, (match_query,)).fetchall()
         if not results:
             return f"No issues found for customer: {name}."
     else:
-        cursor.execute("SELECT name, issue FROM issues ORDER BY id DESC LIMIT 3")
-        results = cursor.fetchall()
+        results = conn.execute(SELECT_RECENT_ISSUES_SQL).fetchall()
         if not results:
             return "No recent issues found in the database."
 
-    conn.close()
-
     formatted_issues = ["--- Fetched Issues ---"]
     for i, (customer_name, issue_desc) in enumerate(results, 1):
         formatted_issues.append(f"Ticket {i}. Customer: {customer_name}, Issue: {issue_desc}")
@@ -131,49 +304,126 @@ Tool Usage Rules:
 
 llm = ChatGroq(
     model=GROQ_MODEL,
-    temperature=0
+    temperature=0,
+    http_client=groq_http_client
 )
 
 tools = [register_customer_issue, get_customer_issues]
 llm_with_tools = llm.bind_tools(tools)
 
+# Built once and shared by every graph tick
+TOOL_MAP = {"register_customer_issue": register_customer_issue,
+            "get_customer_issues": get_customer_issues}
+SYSTEM_MSG = SystemMessage(content=CUSTOMER_SUPPORT_PROMPT)
+
+summary_llm = ChatGroq(
+    model=SUMMARY_MODEL,
+    temperature=0,
+    http_client=groq_http_client
+)
+
+# Prompt window limits: older turns are folded into a running summary
+MAX_PROMPT_TOKENS = 2048
+SUMMARY_THRESHOLD = 30
+KEEP_RECENT_MESSAGES = 10
+
+SUMMARY_PROMPT = """
+Summarize the following customer support conversation in a few sentences.
+Keep customer names, issue descriptions, ticket outcomes and any open questions.
+
+Previous summary:
+{summary}
+
+New conversation turns:
+{transcript}
+"""
+
 
 # --- LangGraph State and Nodes (User's original code) ---
 
 class AgentState(TypedDict):
     messages: Annotated[List[BaseMessage], operator.add]
+    # Running summary of messages[:summarized_upto], which are no longer sent to the LLM
+    summary: str
+    summarized_upto: int
+
+
+def _turn_start(messages: List[BaseMessage], index: int, lower: int) -> int:
+    """Returns the index of the last HumanMessage at or before 'index' (but not before 'lower')."""
+    for i in range(min(index, len(messages) - 1), lower - 1, -1):
+        if isinstance(messages[i], HumanMessage):
+            return i
+    return lower
+
+
+def summarize_messages(summary: str, messages: List[BaseMessage]) -> str:
+    """Folds the given messages into the running conversation summary using the cheaper model."""
+    prompt = SUMMARY_PROMPT.format(summary=summary or "(none)", transcript=get_buffer_string(messages))
+    return summary_llm.invoke(prompt).content
+
+
+def build_prompt(state: AgentState) -> tuple:
+    """Builds the LLM prompt for the current state, returning (prompt_messages, state_update)."""
+    messages = state['messages']
+    summary = state.get('summary', "")
+    summarized_upto = state.get('summarized_upto', 0)
+    update = {}
+
+    # Summarize older turns once the unsummarized history grows past the threshold.
+    # Cut on a user turn so tool calls and their results are never split.
+    if len(messages) - summarized_upto > SUMMARY_THRESHOLD:
+        cutoff = _turn_start(messages, len(messages) - KEEP_RECENT_MESSAGES, summarized_upto)
+        if cutoff > summarized_upto:
+            summary = summarize_messages(summary, messages[summarized_upto:cutoff])
+            summarized_upto = cutoff
+            update = {"summary": summary, "summarized_upto": summarized_upto}
+
+    recent_messages = messages[summarized_upto:]
+    window = trim_messages(
+        recent_messages,
+        max_tokens=MAX_PROMPT_TOKENS,
+        token_counter=count_tokens_approximately,
+        strategy="last",
+        start_on="human",
+        include_system=False,
+    )
+    if not window:
+        # The current turn alone exceeds the budget; send it whole rather than drop it
+        window = recent_messages[_turn_start(recent_messages, len(recent_messages) - 1, 0):]
+
+    prompt_messages = [SYSTEM_MSG]
+    if summary:
+        prompt_messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+    prompt_messages += window
+    return prompt_messages, update
 
 
 def agent_node(state: AgentState):
     """The main node where the LLM decides to respond or call a tool (ReAct Agent)."""
-    messages = state['messages']
-    prompt_messages = [SystemMessage(content=CUSTOMER_SUPPORT_PROMPT)] + messages
+    prompt_messages, update = build_prompt(state)
     response = llm_with_tools.invoke(prompt_messages)
-    return {"messages": [response]}
+    return {"messages": [response], **update}
 
 
 def tool_node(state: AgentState):
     """Executes the tool calls requested by the LLM (Action/Observation)."""
     tool_calls = state['messages'][-1].tool_calls
-    tool_results = []
-
-    for tool_call in tool_calls:
-        tool_name = tool_call["name"]
-        tool_args = tool_call["args"]
-
-        # Map tool name to the function object
-        tool_map = {"register_customer_issue": register_customer_issue,
-                    "get_customer_issues": get_customer_issues}
-        selected_tool = tool_map[tool_name]
 
+    def run_tool_call(tool_call):
         # Execute the tool
-        output = selected_tool.invoke(tool_args)
+        output = TOOL_MAP[tool_call["name"]].invoke(tool_call["args"])
 
-        # Append the tool result as a ToolMessage (more accurate than HumanMessage)
-        tool_results.append(ToolMessage(
+        # Return the tool result as a ToolMessage (more accurate than HumanMessage)
+        return ToolMessage(
             content=output,
             tool_call_id=tool_call["id"],
-        ))
+        )
+
+    # Independent tool calls run concurrently; map() keeps the results in call order
+    if len(tool_calls) == 1:
+        tool_results = [run_tool_call(tool_calls[0])]
+    else:
+        tool_results = list(io_executor.map(run_tool_call, tool_calls))
 
     return {"messages": tool_results}
 
@@ -211,9 +461,323 @@ def create_customer_support_graph():
 # Compile the LangGraph agent globally
 customer_support_app = create_customer_support_graph()
 
+# Same step budget as LangGraph's default recursion_limit
+MAX_AGENT_STEPS = 25
+# Set USE_COMPILED_GRAPH=1 to route chats through the compiled graph instead of stream_agent
+USE_COMPILED_GRAPH = os.getenv("USE_COMPILED_GRAPH") == "1"
+
+
+def _apply_update(state: AgentState, update: dict):
+    """Merges a node's output into the state in place: messages are appended, other keys overwritten."""
+    for key, value in update.items():
+        if key == "messages":
+            state["messages"].extend(value)
+        else:
+            state[key] = value
+
+
+# Sentence boundaries at which streamed reply text is handed to TTS
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def stream_agent(state: AgentState, user_message: HumanMessage,
+                 on_finish: Callable[[AgentState], None]) -> Iterator[str]:
+    """
+    Runs the agent <-> tool loop directly, following the same edges as the compiled graph.
+    The topology is fixed, so this skips LangGraph's per-step dispatch machinery.
+    LLM output is streamed and each completed sentence is yielded as soon as it is generated,
+    so TTS overlaps with generation. A step stops being spoken once tool-call chunks appear
+    (Groq tool-call steps normally carry no text at all). The final state is passed to on_finish.
+    New messages are appended to state['messages'] in place, so a turn costs the same
+    regardless of history length. If the turn fails (or the client disconnects midway),
+    the state, including the user message, is rolled back to how it was before the turn.
+    """
+    messages = state["messages"]
+    turn_start = len(messages)
+    previous_fields = {key: value for key, value in state.items() if key != "messages"}
+    try:
+        messages.append(user_message)
+        for _ in range(MAX_AGENT_STEPS // 2):
+            prompt_messages, update = build_prompt(state)
+            response = None
+            pending_text = ""
+            for chunk in llm_with_tools.stream(prompt_messages):
+                response = chunk if response is None else response + chunk
+                if response.tool_call_chunks:
+                    # A tool-calling step: whatever text it has is not spoken
+                    pending_text = ""
+                elif chunk.content:
+                    pending_text += chunk.content
+                    *completed, pending_text = SENTENCE_END.split(pending_text)
+                    yield from completed
+
+            _apply_update(state, {"messages": [message_chunk_to_message(response)], **update})
+            if should_continue(state) == "end":
+                if pending_text.strip():
+                    yield pending_text
+                on_finish(state)
+                return
+            _apply_update(state, tool_node(state))
+        raise RuntimeError(f"Agent did not finish within {MAX_AGENT_STEPS} steps.")
+    except BaseException:
+        # Never leave a tool call without its result in the stored history
+        del messages[turn_start:]
+        state.clear()
+        state.update(previous_fields, messages=messages)
+        raise
+
+
+# --- Speech and Session Helpers ---
+
+def transcribe_audio(audio_bytes: bytes, filename: str, mimetype: str) -> str:
+    """Transcribes the uploaded audio with Groq Whisper (STT)."""
+    transcription = groq_client.audio.transcriptions.create(
+        file=(filename, audio_bytes, mimetype),
+        model="whisper-large-v3",
+        response_format="text"
+    )
+    return transcription.strip()
+
+
+# Raw UTF-8 bytes of transcription sent in a header (4 KiB once base64-encoded), well under proxy limits
+MAX_TRANSCRIPTION_HEADER_BYTES = 3072
+
+
+def transcription_headers(user_text: str) -> dict:
+    """Encodes the transcription as base64 UTF-8 for the response headers, truncating long utterances."""
+    raw = user_text.encode("utf-8")
+    truncated = len(raw) > MAX_TRANSCRIPTION_HEADER_BYTES
+    if truncated:
+        # Cut on a character boundary so the header always decodes cleanly
+        raw = raw[:MAX_TRANSCRIPTION_HEADER_BYTES].decode("utf-8", "ignore").encode("utf-8")
+    headers = {"X-Transcription-B64": base64.b64encode(raw).decode("ascii")}
+    if truncated:
+        headers["X-Transcription-Truncated"] = "1"
+    return headers
+
+
+def load_session(session_id: str) -> dict:
+    """Returns the stored LangGraph state for a session, restoring or creating it if needed."""
+    with session_lock:
+        # cachetools drops expired entries lazily; spill them now so an expired
+        # session is found in SQLite below instead of being restarted empty
+        conversation_history.expire()
+        state = conversation_history.get(session_id)
+    if state is not None:
+        return state
+
+    row = _conn().execute(SELECT_SESSION_SQL, (session_id,)).fetchone()
+    if row:
+        state = pickle.loads(row[0])
+    else:
+        # Initialize new session state
+        state = {"messages": [], "intermediate_steps": []}
+    with session_lock:
+        return conversation_history.setdefault(session_id, state)
+
+
+# Per-session turn locks: session_id -> [lock, number of requests using it]
+_turn_locks = {}
+
+
+@contextmanager
+def session_turn(session_id: str):
+    """Serializes agent turns of one session, since a turn mutates the session's message list in place."""
+    with session_lock:
+        entry = _turn_locks.setdefault(session_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with session_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _turn_locks[session_id]
+
+
+def save_session(session_id: str, state: dict):
+    """Stores the latest LangGraph state for a session."""
+    with session_lock:
+        conversation_history[session_id] = state
+
+
+NO_SPEECH_RESPONSE_TEXT = "I didn't hear a command. Could you please speak up?"
+ERROR_RESPONSE_TEXT = "I am sorry, an unexpected error occurred. Please check the server logs."
+
+
+# LRU cache of synthesized audio keyed by reply text: text -> (audio_bytes, mimetype)
+TTS_CACHE_SIZE = 512
+_tts_cache = OrderedDict()
+_tts_cache_lock = threading.Lock()
+
+
+def _tts_cache_get(text: str):
+    with _tts_cache_lock:
+        cached = _tts_cache.get(text)
+        if cached is not None:
+            _tts_cache.move_to_end(text)
+        return cached
+
+
+def _tts_cache_put(text: str, audio: tuple):
+    with _tts_cache_lock:
+        _tts_cache[text] = audio
+        _tts_cache.move_to_end(text)
+        if len(_tts_cache) > TTS_CACHE_SIZE:
+            _tts_cache.popitem(last=False)
+
+
+def synthesize_speech(text: str) -> tuple:
+    """
+    Synthesizes speech for the text, returning (audio_bytes, mimetype).
+    Results are cached by text, so repeated replies skip synthesis entirely.
+    """
+    cached = _tts_cache_get(text)
+    if cached is not None:
+        return cached
+
+    audio = None
+    if piper_voice is not None:
+        try:
+            audio_buffer = io.BytesIO()
+            with wave.open(audio_buffer, "wb") as wav_file:
+                if hasattr(piper_voice, "synthesize_wav"):
+                    # piper-tts >= 1.3: synthesize() became a chunk generator; synthesize_wav() writes the file
+                    piper_voice.synthesize_wav(text, wav_file)
+                else:
+                    piper_voice.synthesize(text, wav_file)
+            audio = audio_buffer.getvalue(), "audio/wav"
+        except Exception as e:
+            logging.error(f"Piper synthesis failed: {e}. Falling back to gTTS.")
+
+    if audio is None:
+        audio = b"".join(gTTS(text=text, lang='en').stream()), "audio/mpeg"
+    _tts_cache_put(text, audio)
+    return audio
+
+
+def stream_gtts(text: str) -> Iterator[bytes]:
+    """Yields MP3 bytes for the text as gTTS receives each part, caching the full audio at the end."""
+    cached = _tts_cache_get(text)
+    if cached is not None:
+        yield cached[0]
+        return
+
+    parts = []
+    for part in gTTS(text=text, lang='en').stream():
+        parts.append(part)
+        yield part
+    _tts_cache_put(text, (b"".join(parts), "audio/mpeg"))
+
+
+# Streamed replies use a single container for the whole response, chosen by the TTS engine
+STREAM_MIMETYPE = "audio/wav" if piper_voice is not None else "audio/mpeg"
+
+
+def _wav_frames(wav_bytes: bytes) -> tuple:
+    """Splits WAV file bytes into (params, raw PCM frames)."""
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wav_file:
+        return wav_file.getparams(), wav_file.readframes(wav_file.getnframes())
+
+
+def _streaming_wav_header(params) -> bytes:
+    """Builds a PCM WAV header with open-ended sizes, for audio whose total length is not known yet."""
+    block_align = params.nchannels * params.sampwidth
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 0xFFFFFFFF, b"WAVE",
+        b"fmt ", 16, 1, params.nchannels, params.framerate,
+        params.framerate * block_align, block_align, params.sampwidth * 8,
+        b"data", 0xFFFFFFFF,
+    )
+
+
+def stream_speech(sentences: Iterable[str]) -> Iterator[bytes]:
+    """
+    Synthesizes each sentence as soon as it arrives and yields one continuous audio stream
+    in STREAM_MIMETYPE. Errors raised while producing sentences are spoken as the error reply.
+    """
+    header_sent = False
+
+    def encode(sentence):
+        nonlocal header_sent
+        if STREAM_MIMETYPE == "audio/mpeg":
+            # MP3 frames can simply be concatenated, so pass gTTS output through as it arrives
+            yield from stream_gtts(sentence)
+            return
+
+        audio_bytes, mimetype = synthesize_speech(sentence)
+        if mimetype != STREAM_MIMETYPE:
+            logging.error(f"Skipping sentence synthesized as {mimetype} in a {STREAM_MIMETYPE} stream.")
+            return
+        params, frames = _wav_frames(audio_bytes)
+        if not header_sent:
+            yield _streaming_wav_header(params)
+            header_sent = True
+        yield frames
+
+    try:
+        for sentence in sentences:
+            yield from encode(sentence)
+    except Exception as e:
+        logging.error(f"An error occurred while streaming the reply: {e}")
+        yield from encode(ERROR_RESPONSE_TEXT)
+    finally:
+        # If the client goes away, close the producer now so it rolls back and releases its locks
+        if hasattr(sentences, "close"):
+            sentences.close()
+
+
+def prewarm_tts_cache():
+    """Synthesizes the canned replies ahead of time so they are served from cache."""
+    for text in (NO_SPEECH_RESPONSE_TEXT, ERROR_RESPONSE_TEXT):
+        try:
+            synthesize_speech(text)
+        except Exception as e:
+            logging.warning(f"Could not pre-synthesize canned reply: {e}")
+
+
+def audio_response(text: str, download_stem: str):
+    """Builds a Flask response carrying the spoken version of the text."""
+    audio_bytes, mimetype = synthesize_speech(text)
+    extension = "wav" if mimetype == "audio/wav" else "mp3"
+    return make_response(send_file(
+        io.BytesIO(audio_bytes),
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=f"{download_stem}.{extension}"
+    ))
+
+
+# --- Startup ---
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def init_app():
+    """
+    Prepares the process to serve requests: database schema and TTS cache warm-up.
+    Idempotent; called from the __main__ entrypoint, from Gunicorn's post_worker_init hook,
+    and lazily before each request so any other entrypoint (flask run, plain gunicorn) works too.
+    """
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        setup_database()
+        io_executor.submit(prewarm_tts_cache)
+        _initialized = True
+
 
 # --- Flask Server Routes for Voice/Chat Capability ---
 
+app.before_request(init_app)
+
+
 @app.route('/')
 def home():
     """Simple check to ensure the server is running."""
@@ -239,62 +803,67 @@ def chat():
 
         response_headers = {"X-Session-ID": session_id}
 
-        # 1. Save audio temporarily for Whisper API
-        temp_audio_path = Path(f"temp_user_input_{session_id}.wav")
-        audio_file.save(temp_audio_path)
+        # 1. Read the uploaded audio into memory for the Whisper API
+        audio_bytes = audio_file.read()
 
-        # 2. Transcribe Audio (STT)
-        with open(temp_audio_path, "rb") as audio:
-            transcription = groq_client.audio.transcriptions.create(
-                file=audio,
-                model="whisper-large-v3",
-                response_format="text"
-            )
-        user_text = transcription.strip()
-        os.remove(temp_audio_path)
+        # 2. Transcribe Audio (STT) on the request thread while the session state is loaded in parallel
+        session_future = io_executor.submit(load_session, session_id)
+        user_text = transcribe_audio(
+            audio_bytes,
+            audio_file.filename or "input.wav",
+            audio_file.mimetype or "audio/wav",
+        )
 
         logging.info(f"User said (Transcription): {user_text}")
-        response_headers["X-Transcription"] = user_text
+        response_headers.update(transcription_headers(user_text))
 
         if not user_text:
-            response_text = "I didn't hear a command. Could you please speak up?"
+            logging.info(f"Assistant says: {NO_SPEECH_RESPONSE_TEXT}")
+            response = audio_response(NO_SPEECH_RESPONSE_TEXT, "response")
         else:
             # 3. Invoke LangGraph Agent
-            if session_id not in conversation_history:
-                # Initialize new session state
-                conversation_history[session_id] = {"messages": [], "intermediate_steps": []}
-
+            # The prefetch above warms the session cache; the state is re-read under the turn lock
+            session_future.result()
             user_message = HumanMessage(content=user_text)
-            current_state = conversation_history[session_id]
-            new_state = current_state.copy()
-            new_state['messages'] = current_state['messages'] + [user_message]
 
             logging.info("Invoking LangGraph agent...")
 
-            # Using the pre-compiled graph
-            result = customer_support_app.invoke(new_state)
-
-            ai_response_message = result["messages"][-1]
-            response_text = ai_response_message.content
-
-            # Update history state
-            conversation_history[session_id] = result
-
-        logging.info(f"Assistant says: {response_text}")
-
-        # 4. Generate Spoken Response (TTS)
-        tts = gTTS(text=response_text, lang='en')
-        audio_buffer = io.BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
+            if USE_COMPILED_GRAPH:
+                with session_turn(session_id):
+                    current_state = load_session(session_id)
+                    # Using the pre-compiled graph; the stored history is only replaced on success
+                    result = customer_support_app.invoke(
+                        {**current_state, "messages": current_state["messages"] + [user_message]}
+                    )
+                    response_text = result["messages"][-1].content
+                    logging.info(f"Assistant says: {response_text}")
+
+                    # Update history state
+                    save_session(session_id, result)
+
+                # 4. Generate Spoken Response (TTS)
+                response = audio_response(response_text, "response")
+            else:
+                def finish_turn(result):
+                    logging.info(f"Assistant says: {result['messages'][-1].content}")
+                    # Update history state
+                    save_session(session_id, result)
+
+                def turn_sentences():
+                    # Held until the streamed turn finishes, so turns of one session never interleave
+                    with session_turn(session_id):
+                        current_state = load_session(session_id)
+                        yield from stream_agent(current_state, user_message, on_finish=finish_turn)
+
+                # 4. Stream the Spoken Response: each sentence is synthesized while the LLM keeps generating
+                response = Response(
+                    stream_with_context(stream_speech(turn_sentences())),
+                    mimetype=STREAM_MIMETYPE,
+                )
+                extension = "wav" if STREAM_MIMETYPE == "audio/wav" else "mp3"
+                response.headers["Content-Disposition"] = f"attachment; filename=response.{extension}"
 
         # 5. Return Audio Response
-        response = make_response(send_file(
-            audio_buffer,
-            mimetype="audio/mpeg",
-            as_attachment=True,
-            download_name="response.mp3"
-        ))
         for key, value in response_headers.items():
             response.headers[key] = value
 
@@ -303,18 +872,7 @@ def chat():
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         # Error handling response via TTS
-        error_response_text = "I am sorry, an unexpected error occurred. Please check the server logs."
-        tts = gTTS(text=error_response_text, lang='en')
-        audio_buffer = io.BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
-
-        error_response = make_response(send_file(
-            audio_buffer,
-            mimetype="audio/mpeg",
-            as_attachment=True,
-            download_name="error.mp3"
-        ))
+        error_response = audio_response(ERROR_RESPONSE_TEXT, "error")
         error_response.status_code = 500
         return error_response
 
@@ -322,7 +880,9 @@ def chat():
 # --- Main Execution ---
 
 if __name__ == '__main__':
+    init_app()
     print("\n--- Customer Support Voice Assistant Server Initialized ---")
     print("Ensure you have a GROQ_API_KEY and the necessary Python libraries installed.")
-    print("Running server on http://127.0.0.1:5000")
-    app.run(debug=True, port=5000, host='0.0.0.0')
+    print("Running server on http://127.0.0.1:5000 (use gunicorn -c gunicorn.conf.py for production)")
+    # The debugger and reloader are opt-in for local development (FLASK_DEBUG=1)
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", port=5000, host='0.0.0.0')